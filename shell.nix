@@ -17,6 +17,7 @@ let
     ps.numpy
     ps.scipy
     ps.matplotlib
+    ps.numba
 
     ps.black
   ]);
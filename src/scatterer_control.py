@@ -2,16 +2,18 @@ from utils import mesh
 from utils import measure_mesh
 
 import argparse
+import hashlib
 import numpy as np
 import numpy.typing as npt
 import math
 import matplotlib.animation as plt_anim
 import matplotlib.pyplot as plt
-import pydec
+import numba
+import os
 import scipy.sparse as sps
 from dataclasses import dataclass
 from time import perf_counter_ns
-from typing import Callable, Iterable
+from typing import Callable
 
 # figure size with a good font size for embedding
 plt.rcParams["figure.figsize"] = [6, 6]
@@ -56,6 +58,20 @@ arg_parser.add_argument(
     default=50,
     help="maximum iteration count for the conjugate gradient algorithm",
 )
+arg_parser.add_argument(
+    "--single-precision",
+    dest="single_precision",
+    action="store_true",
+    help="run wave simulations in single instead of double precision",
+)
+arg_parser.add_argument(
+    "--precond-probes",
+    dest="precond_probes",
+    type=int,
+    default=0,
+    help="number of random probes used to estimate a diagonal preconditioner "
+    "for the conjugate gradient algorithm, 0 to not precondition",
+)
 arg_parser.add_argument(
     "--inc-angle",
     dest="inc_angle",
@@ -76,6 +92,12 @@ arg_parser.add_argument(
     action="store_true",
     help="hide the incident wave in the animated visualization",
 )
+arg_parser.add_argument(
+    "--no-cache",
+    dest="no_cache",
+    action="store_true",
+    help="recompute the initial state instead of loading it from .cache",
+)
 arg_parser.add_argument(
     "--save-visuals",
     dest="save_visuals",
@@ -124,34 +146,42 @@ outer_bound_edges: list[int] = cmp_mesh.edge_groups["outer boundary"]
 measure_mesh.print_measurements(cmp_complex)
 print("")
 
+# boundary edges as flat arrays so that boundary conditions
+# can be applied to all of them at once with numpy indexing
+inner_bound_idx = np.asarray(inner_bound_edges, dtype=np.intp)
+outer_bound_idx = np.asarray(outer_bound_edges, dtype=np.intp)
 
 # for each outer boundary edge, find the triangle this edge is part of
-# and save some info for computing the absorbing boundary condition
-@dataclass
-class BoundaryEdgeInfo:
-    dual_vert_idx: int
-    length: float
-    orientation: int
-
-
-outer_bound_infos: list[BoundaryEdgeInfo] = []
-for edge_idx in outer_bound_edges:
-    # find the triangle using the incidence matrix
-    tri_indices = cmp_complex[1].d[:, edge_idx].nonzero()[0]
-    assert len(tri_indices) == 1, "boundary edge is part of one triangle only"
-    edge_ends = [cmp_complex.vertices[v] for v in cmp_complex[1].simplices[edge_idx]]
-    outer_bound_infos.append(
-        BoundaryEdgeInfo(
-            dual_vert_idx=tri_indices[0],
-            orientation=cmp_complex[1].d[tri_indices[0], edge_idx],
-            length=float(np.linalg.norm(edge_ends[1] - edge_ends[0])),
-        )
-    )
+# and save some info for computing the absorbing boundary condition.
+# the triangles are found from the incidence matrix's columns
+outer_bound_incidence = sps.csc_matrix(cmp_complex[1].d[:, outer_bound_idx])
+outer_bound_incidence.eliminate_zeros()
+assert np.all(
+    np.diff(outer_bound_incidence.indptr) == 1
+), "boundary edge is part of one triangle only"
+outer_bound_dual_idx = outer_bound_incidence.indices.astype(np.intp)
+outer_bound_ends = cmp_complex.vertices[cmp_complex[1].simplices[outer_bound_idx]]
+# edge length times orientation relative to the triangle
+outer_bound_coefs = np.linalg.norm(
+    outer_bound_ends[:, 1] - outer_bound_ends[:, 0], axis=1
+) * outer_bound_incidence.data.astype(np.float64)
 
 #
 # simulation parameters and helpers
 #
 
+# floating point type used for the state in wave simulations.
+# double precision by default; single precision halves the size of the state
+# but hasn't been measured to be faster.
+# the conjugate gradient method always works in double precision,
+# but its residual is updated recursively and never recomputed as b - Ax,
+# so with single precision the rounding errors in A
+# (which also make it slightly nonsymmetric)
+# accumulate over the iterations instead of being corrected.
+# states are converted to this type when a simulation starts
+# and back to float64 when their results are used in the CG method
+sim_dtype = np.float32 if args.single_precision else np.float64
+
 # incident wave parameters
 inc_wavenumber = args.wavenumber
 wave_speed = 1.0
@@ -169,11 +199,38 @@ inc_angular_vel = inc_wavenumber * wave_speed
 wave_period = (2.0 * np.pi) / inc_angular_vel
 dt = 0.1 * min(cmp_complex[1].primal_volume)
 steps_per_period = math.ceil(wave_period / dt)
+# length of the simulation that eases in the source terms
+# to compute the initial state for optimization
+transition_time = 5 * wave_period
+transition_step_count = math.ceil(transition_time / dt)
 
 # time stepping matrices
 
+
+@dataclass
+class StepMatrices:
+    """A pair of timestep operators converted to CSR format
+    and the simulation floating point type once up front,
+    along with their transposes used in the backward equation,
+    so that each matrix-vector product in a timestep is a single scipy call."""
+
+    # identifies the timestepping method in cache keys
+    name: str
+    p: sps.csr_matrix
+    q: sps.csr_matrix
+    p_t: sps.csr_matrix
+    q_t: sps.csr_matrix
+
+    @classmethod
+    def from_operators(cls, name: str, p_step_mat, q_step_mat):
+        p = sps.csr_matrix(p_step_mat, dtype=sim_dtype)
+        q = sps.csr_matrix(q_step_mat, dtype=sim_dtype)
+        return cls(name=name, p=p, q=q, p_t=p.T.tocsr(), q_t=q.T.tocsr())
+
+
 p_step_mat_yee = dt * wave_speed**2 * cmp_complex[2].star * cmp_complex[1].d
 q_step_mat_yee = dt * cmp_complex[1].star_inv * cmp_complex[1].d.T
+step_mats_yee = StepMatrices.from_operators("yee", p_step_mat_yee, q_step_mat_yee)
 
 print("Computing harmonic timestep operators...")
 
@@ -213,58 +270,231 @@ star_2 = sps.diags(star_2_diag)
 harmonic_dt = (2.0 / inc_angular_vel) * math.sin(inc_angular_vel * dt / 2.0)
 p_step_mat_har = harmonic_dt * wave_speed**2 * star_2 * cmp_complex[1].d
 q_step_mat_har = harmonic_dt * star_1_inv * cmp_complex[1].d.T
+step_mats_har = StepMatrices.from_operators("harmonic", p_step_mat_har, q_step_mat_har)
 
 # using global state to set which timestep matrices are active.
 # TODO: this is super ugly, this (and the rest of the global variables)
 # should be encapsulated and parameterized better
-p_step_mat = p_step_mat_har
-q_step_mat = q_step_mat_har
+step_mats = step_mats_har
 
 
 # utilities for computing the incident wave
-def eval_inc_wave_pressure(t, position: npt.NDArray) -> float:
-    """Evaluate the value of v for the incident plane wave at a point."""
+def eval_inc_wave_pressure(t, position: npt.NDArray) -> npt.NDArray[np.float64]:
+    """Evaluate the value of v for the incident plane wave
+    at a point or an array of points."""
 
-    return inc_angular_vel * math.sin(
-        inc_angular_vel * t - np.dot(inc_wave_vector, position)
-    )
+    return inc_angular_vel * np.sin(inc_angular_vel * t - position @ inc_wave_vector)
+
+
+@dataclass
+class EdgeWaveCoefs:
+    """Time-independent parts of `eval_inc_wave_flux` for a set of edges,
+    precomputed so the flux can be evaluated on all of them at once."""
+
+    kdotp: npt.NDArray[np.float64]
+    kdotl: npt.NDArray[np.float64]
+    kdotn: npt.NDArray[np.float64]
+    # edges nearly orthogonal to the wave vector need a different formula
+    # to avoid dividing by zero
+    orthogonal: npt.NDArray[np.bool_]
+
+    def subset(self, edge_idx):
+        return EdgeWaveCoefs(
+            kdotp=self.kdotp[edge_idx],
+            kdotl=self.kdotl[edge_idx],
+            kdotn=self.kdotn[edge_idx],
+            orthogonal=self.orthogonal[edge_idx],
+        )
 
 
-def eval_inc_wave_flux(t: float, edge_vert_indices: Iterable[int]) -> float:
+# none of these depend on time, so compute them once for every edge
+edge_ends = cmp_complex.vertices[cmp_complex[1].simplices]
+edge_vecs = edge_ends[:, 1] - edge_ends[:, 0]
+edge_kdotl = edge_vecs @ inc_wave_vector
+edge_wave_coefs = EdgeWaveCoefs(
+    kdotp=edge_ends[:, 0] @ inc_wave_vector,
+    kdotl=edge_kdotl,
+    kdotn=np.column_stack((edge_vecs[:, 1], -edge_vecs[:, 0])) @ inc_wave_vector,
+    orthogonal=np.abs(edge_kdotl) < 1e-5,
+)
+
+
+def eval_inc_wave_flux(t, edge_idx=slice(None)) -> npt.NDArray[np.float64]:
     """Evaluate the line integral of the area flux of the incident wave
-    over an edge of the mesh, in other words compute a value of `q` from the wave."""
+    over the edges selected by `edge_idx` (all edges by default),
+    in other words compute values of `q` from the wave.
+    `t` may also be a column of time values, giving one row per time."""
+
+    coefs = edge_wave_coefs.subset(edge_idx)
+    phase = inc_angular_vel * t - coefs.kdotp
+    # replace the orthogonal edges' denominators with something nonzero,
+    # their values come from the other branch anyway
+    safe_kdotl = np.where(coefs.orthogonal, 1.0, coefs.kdotl)
+    return np.where(
+        coefs.orthogonal,
+        -coefs.kdotn * np.sin(phase),
+        (coefs.kdotn / safe_kdotl) * (np.cos(phase) - np.cos(phase - coefs.kdotl)),
+    )
 
-    p = [cmp_complex.vertices[v] for v in edge_vert_indices]
-    kdotp = np.dot(inc_wave_vector, p[0])
-    l = p[1] - p[0]
-    kdotl = np.dot(inc_wave_vector, l)
-    kdotn = np.dot(inc_wave_vector, np.array([l[1], -l[0]]))
-    wave_angle = inc_angular_vel * t
 
-    if abs(kdotl) < 1e-5:
-        return -kdotn * math.sin(wave_angle - kdotp)
-    else:
-        return (kdotn / kdotl) * (
-            math.cos(wave_angle - kdotp) - math.cos(wave_angle - kdotp - kdotl)
-        )
+inner_bound_mask = np.zeros(cmp_complex[1].num_simplices, dtype=np.bool_)
+inner_bound_mask[inner_bound_idx] = True
+
+# the incident wave on the scatterer's surface doesn't depend on the state,
+# so it's tabulated for every timestep of the longest simulation,
+# the eased-in transition that computes the initial state.
+# row i is used on timestep i + 1, where q is computed at time (i + 1.5) * dt
+inner_bound_flux_table = eval_inc_wave_flux(
+    dt * (np.arange(1, transition_step_count + 1) + 0.5)[:, np.newaxis],
+    inner_bound_idx,
+).astype(sim_dtype)
+
+
+@numba.njit(cache=True, fastmath=True, parallel=True)
+def forward_step_kernel(
+    pressure,
+    flux,
+    p_indptr,
+    p_indices,
+    p_data,
+    q_indptr,
+    q_indices,
+    q_data,
+    inner_idx,
+    inner_flux,
+    source_scaling,
+    outer_idx,
+    outer_dual_idx,
+    outer_coefs,
+):
+    """Compiled body of `ForwardSolve.step`.
+    Performs both sparse matrix-vector products and applies boundary conditions
+    in one call, updating `pressure` and `flux` in place.
+
+    The matrix-vector products write to a distinct element on each row,
+    so they are run in parallel. The boundary loops only cover
+    a few dozen edges, too few to be worth starting parallel threads for."""
+
+    for row in numba.prange(len(pressure)):
+        acc = 0.0
+        for k in range(p_indptr[row], p_indptr[row + 1]):
+            acc += p_data[k] * flux[p_indices[k]]
+        pressure[row] += acc
+
+    for row in numba.prange(len(flux)):
+        acc = 0.0
+        for k in range(q_indptr[row], q_indptr[row + 1]):
+            acc += q_data[k] * pressure[q_indices[k]]
+        flux[row] += acc
+
+    # incident wave on the scatterer's surface
+    for i in range(len(inner_idx)):
+        flux[inner_idx[i]] = source_scaling * inner_flux[i]
+
+    # absorbing outer boundary condition
+    for i in range(len(outer_idx)):
+        flux[outer_idx[i]] = -pressure[outer_dual_idx[i]] * outer_coefs[i]
+
+
+def build_quiver_matrix() -> tuple[npt.NDArray[np.float64], sps.csr_matrix]:
+    """Precompute the arrows drawn for the velocity in visualizations.
+    Same as `pydec.simplex_quivers` rotated by 90 degrees
+    (since the flux is the velocity's normal component),
+    but as a linear map so it's a single matrix-vector product per frame.
+
+    Returns the arrow bases at triangle barycenters
+    and a matrix `Q` such that `(Q @ flux).reshape(-1, 2)` are the arrows."""
+
+    tris = np.sort(cmp_complex[2].simplices, axis=1)
+    tri_verts = cmp_complex.vertices[tris]
+    bases = tri_verts.mean(axis=1)
+
+    # barycentric coordinate gradients of each triangle's vertices
+    edge_vecs = np.stack(
+        (tri_verts[:, 1] - tri_verts[:, 0], tri_verts[:, 2] - tri_verts[:, 0]),
+        axis=2,
+    )
+    grads_12 = np.linalg.inv(edge_vecs)
+    bary_grads = np.concatenate(
+        (-grads_12.sum(axis=1, keepdims=True), grads_12), axis=1
+    )
+
+    # edge indices by their (sorted) vertex indices
+    edges = cmp_complex[1].simplices
+    vert_count = len(cmp_complex.vertices)
+    edge_lookup = sps.csr_matrix(
+        (np.arange(1, len(edges) + 1), (edges[:, 0], edges[:, 1])),
+        shape=(vert_count, vert_count),
+    )
+
+    # the Whitney 1-form of edge (i, j) evaluated at the barycenter
+    # is (grad lambda_j - grad lambda_i) / 3
+    tri_idx = np.arange(len(tris))
+    rows = []
+    cols = []
+    data = []
+    for i, j in ((0, 1), (0, 2), (1, 2)):
+        edge_idx = np.asarray(edge_lookup[tris[:, i], tris[:, j]]).ravel() - 1
+        # a missing entry would silently index the last edge
+        assert (edge_idx >= 0).all(), "edges are stored with sorted vertex indices"
+        arrow = (bary_grads[:, j] - bary_grads[:, i]) / 3.0
+        # rotate the arrow to get the velocity direction
+        rows += [2 * tri_idx, 2 * tri_idx + 1]
+        cols += [edge_idx, edge_idx]
+        data += [arrow[:, 1], -arrow[:, 0]]
+    quiver_mat = sps.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(2 * len(tris), len(edges)),
+    )
+    return bases, quiver_mat
+
+
+quiver_bases, quiver_mat = build_quiver_matrix()
 
 
-@dataclass
 class State:
     """State vector with named parts for convenience
-    and methods for visualization."""
+    and methods for visualization.
+
+    The parts are views into one contiguous array `x`,
+    so operations on the whole state are single numpy calls.
+    Either give the parts (zero if omitted) or the whole array."""
 
-    pressure: npt.NDArray[np.float64] = np.zeros(cmp_complex[2].num_simplices)
-    flux: npt.NDArray[np.float64] = np.zeros(cmp_complex[1].num_simplices)
+    __slots__ = ("x", "pressure", "flux")
+
+    pressure_len = cmp_complex[2].num_simplices
+    flux_len = cmp_complex[1].num_simplices
+
+    def __init__(
+        self,
+        pressure: npt.NDArray | None = None,
+        flux: npt.NDArray | None = None,
+        x: npt.NDArray | None = None,
+    ):
+        if x is None:
+            parts = [part for part in (pressure, flux) if part is not None]
+            dtype = np.result_type(*parts) if parts else np.float64
+            x = np.zeros(self.pressure_len + self.flux_len, dtype=dtype)
+            if pressure is not None:
+                x[: self.pressure_len] = pressure
+            if flux is not None:
+                x[self.pressure_len :] = flux
+        self.x = x
+        self.pressure = x[: self.pressure_len]
+        self.flux = x[self.pressure_len :]
 
     def copy(self):
-        return State(pressure=self.pressure.copy(), flux=self.flux.copy())
+        return State(x=self.x.copy())
+
+    def astype(self, dtype):
+        """Copy of the state converted to the given floating point type."""
+        return State(x=self.x.astype(dtype))
 
     def scaled(self, s: float):
-        return State(pressure=s * self.pressure, flux=s * self.flux)
+        return State(x=s * self.x)
 
     def dot(self, other) -> float:
-        return np.dot(self.pressure, other.pressure) + np.dot(self.flux, other.flux)
+        return float(np.dot(self.x, other.x))
 
     def energy(self) -> float:
         """Control energy of the exact controllability problem.
@@ -277,17 +507,32 @@ class State:
         return math.sqrt(self.dot(self))
 
     def __add__(self, other):
-        return State(
-            pressure=self.pressure + other.pressure, flux=self.flux + other.flux
-        )
+        return State(x=self.x + other.x)
 
     def __sub__(self, other):
-        return State(
-            pressure=self.pressure - other.pressure, flux=self.flux - other.flux
-        )
+        return State(x=self.x - other.x)
 
     def __neg__(self):
-        return State(pressure=-self.pressure, flux=-self.flux)
+        return State(x=-self.x)
+
+    # in-place variants of the above to avoid allocating new arrays
+    # in the conjugate gradient loop
+
+    def __iadd__(self, other):
+        self.x += other.x
+        return self
+
+    def __isub__(self, other):
+        self.x -= other.x
+        return self
+
+    def __imul__(self, s: float):
+        self.x *= s
+        return self
+
+    def add_scaled(self, other, s: float):
+        """In-place `self += other.scaled(s)`."""
+        self.x += s * other.x
 
     def draw(self, save: bool = False):
         """Draw a still image of the state.
@@ -316,11 +561,10 @@ class State:
             vmax=inc_wavenumber * vlims[1],
         )
         if draw_velocity:
-            barys, arrows = pydec.simplex_quivers(cmp_complex, self.flux)
-            arrows = np.vstack((arrows[:, 1], -arrows[:, 0])).T
+            arrows = (quiver_mat @ self.flux).reshape(-1, 2)
             ax.quiver(
-                barys[:, 0],
-                barys[:, 1],
+                quiver_bases[:, 0],
+                quiver_bases[:, 1],
                 arrows[:, 0],
                 arrows[:, 1],
                 units="dots",
@@ -338,7 +582,7 @@ class State:
         with the incident wave added and velocity arrows removed.
         Good for social media posting!"""
 
-        sim_fwd = ForwardSolve(state=self.copy())
+        sim_fwd = ForwardSolve(state=self.astype(sim_dtype))
         fig = plt.figure(figsize=size)
         ax = fig.add_subplot(1, 1, 1)
 
@@ -369,17 +613,11 @@ def eval_inc_wave_everywhere(t: float) -> State:
     """Evaluate the incident plane wave on every feature of the mesh.
     Used to add the incident wave to the final visualization."""
 
-    state = State()
-    for vert_idx in range(len(state.pressure)):
-        state.pressure[vert_idx] = eval_inc_wave_pressure(
-            t, cmp_complex[2].circumcenter[vert_idx]
-        )
-    for edge_idx in range(len(state.flux)):
-        if edge_idx in inner_bound_edges:
-            continue
-        state.flux[edge_idx] = eval_inc_wave_flux(
-            t + 0.5 * dt, cmp_complex[1].simplices[edge_idx]
-        )
+    state = State(
+        pressure=eval_inc_wave_pressure(t, cmp_complex[2].circumcenter),
+        flux=eval_inc_wave_flux(t + 0.5 * dt),
+    )
+    state.flux[inner_bound_mask] = 0.0
     return state
 
 
@@ -391,29 +629,46 @@ def eval_inc_wave_everywhere(t: float) -> State:
 @dataclass
 class ForwardSolve:
     state: State
-    t: float = 0.0
+    # number of timesteps taken, starting from time 0
+    step_idx: int = 0
+
+    @property
+    def t(self) -> float:
+        return self.step_idx * dt
 
-    def step(self, source_term_scaling: Callable[[float], float] = lambda _: 1.0):
-        """Solve one timestep in the forward equation."""
+    def step(self, source_term_scaling: float | Callable[[float], float] = 1.0):
+        """Solve one timestep in the forward equation.
+        `source_term_scaling` is either a constant
+        or a function of time that is called once per step."""
 
-        self.t += dt
-        self.state.pressure += p_step_mat @ self.state.flux
+        self.step_idx += 1
         # q is computed at a time instance offset by half dt
         t_at_w = self.t + 0.5 * dt
-        self.state.flux += q_step_mat @ self.state.pressure
-        # incident wave on the scatterer's surface
-        for edge_idx in inner_bound_edges:
-            self.state.flux[edge_idx] = source_term_scaling(
-                t_at_w
-            ) * eval_inc_wave_flux(t_at_w, cmp_complex[1].simplices[edge_idx])
-
-        # absorbing outer boundary condition
-        for edge_idx, edge_info in zip(outer_bound_edges, outer_bound_infos):
-            self.state.flux[edge_idx] = (
-                -self.state.pressure[edge_info.dual_vert_idx]
-                * edge_info.length
-                * edge_info.orientation
-            )
+        if callable(source_term_scaling):
+            source_scaling = source_term_scaling(t_at_w)
+        else:
+            source_scaling = source_term_scaling
+        if self.step_idx <= len(inner_bound_flux_table):
+            inner_flux = inner_bound_flux_table[self.step_idx - 1]
+        else:
+            # not reached by any simulation in this script
+            inner_flux = eval_inc_wave_flux(t_at_w, inner_bound_idx)
+        forward_step_kernel(
+            self.state.pressure,
+            self.state.flux,
+            step_mats.p.indptr,
+            step_mats.p.indices,
+            step_mats.p.data,
+            step_mats.q.indptr,
+            step_mats.q.indices,
+            step_mats.q.data,
+            inner_bound_idx,
+            inner_flux,
+            source_scaling,
+            outer_bound_idx,
+            outer_bound_dual_idx,
+            outer_bound_coefs,
+        )
 
 
 @dataclass
@@ -423,20 +678,16 @@ class BackwardSolve:
     def step(self):
         """Solve one timestep in the backward equation."""
 
-        self.state.flux += p_step_mat.T @ self.state.pressure
+        self.state.flux += step_mats.p_t @ self.state.pressure
         # inner Dirichlet boundary without source term
-        for edge_idx in inner_bound_edges:
-            self.state.flux[edge_idx] = 0.0
+        self.state.flux[inner_bound_idx] = 0.0
         # absorbing outer boundary
         # with flipped sign due to going backward in time
-        for edge_idx, edge_info in zip(outer_bound_edges, outer_bound_infos):
-            self.state.flux[edge_idx] = (
-                self.state.pressure[edge_info.dual_vert_idx]
-                * edge_info.length
-                * edge_info.orientation
-            )
+        self.state.flux[outer_bound_idx] = (
+            self.state.pressure[outer_bound_dual_idx] * outer_bound_coefs
+        )
 
-        self.state.pressure += q_step_mat.T @ self.state.flux
+        self.state.pressure += step_mats.q_t @ self.state.flux
 
 
 @dataclass
@@ -451,6 +702,17 @@ class GradientResult:
         return self.forward_diff.energy()
 
 
+# preallocated simulation states reused by every cost gradient computation
+# so that the conjugate gradient iterations don't allocate them each time.
+# "fwd" is the forward simulation, "diff" the forward difference
+# and "bwd" the backward simulation
+gradient_scratch = {
+    "fwd": State().astype(sim_dtype),
+    "diff": State().astype(sim_dtype),
+    "bwd": State().astype(sim_dtype),
+}
+
+
 def compute_cost_gradient(
     initial_state: State, use_source_terms: bool = True
 ) -> GradientResult:
@@ -463,39 +725,86 @@ def compute_cost_gradient(
     Else, corresponds to computing Ax in the same system."""
 
     # solve the forward equation
-    sim_fwd = ForwardSolve(state=initial_state.copy())
-    source_scaling = (lambda _: 1.0) if use_source_terms else (lambda _: 0.0)
+    fwd_state = gradient_scratch["fwd"]
+    fwd_state.x[:] = initial_state.x
+    sim_fwd = ForwardSolve(state=fwd_state)
+    source_scaling = 1.0 if use_source_terms else 0.0
     for _ in range(steps_per_period):
         sim_fwd.step(source_term_scaling=source_scaling)
-    final_state = sim_fwd.state
 
-    # compute starting value for the backward equation
-    fwd_diff = final_state - initial_state
-    bwd_init_q = -fwd_diff.flux
-    bwd_init_state = State(
-        flux=bwd_init_q,
-        pressure=(q_step_mat.T @ bwd_init_q) - fwd_diff.pressure,
+    fwd_diff = sim_fwd.state.astype(np.float64)
+    fwd_diff -= initial_state
+
+    return GradientResult(
+        gradient=solve_adjoint_gradient(fwd_diff),
+        forward_diff=fwd_diff,
     )
 
+
+def solve_adjoint_gradient(fwd_diff: State) -> State:
+    """Solve the backward (adjoint) equation
+    starting from the difference between the initial and final states
+    of a forward simulation, giving the gradient of the cost function."""
+
+    diff = gradient_scratch["diff"]
+    diff.x[:] = fwd_diff.x
+
+    # compute starting value for the backward equation
+    bwd_init_state = gradient_scratch["bwd"]
+    np.negative(diff.flux, out=bwd_init_state.flux)
+    bwd_init_state.pressure[:] = step_mats.q_t @ bwd_init_state.flux
+    bwd_init_state.pressure -= diff.pressure
+
     # solve the backward equation
-    sim_bwd = BackwardSolve(state=bwd_init_state.copy())
+    sim_bwd = BackwardSolve(state=bwd_init_state)
     for _ in range(steps_per_period - 1):
         sim_bwd.step()
-    final_bwd_state = State(
-        pressure=-sim_bwd.state.pressure,
-        flux=-sim_bwd.state.flux - p_step_mat.T @ sim_bwd.state.pressure,
-    )
 
-    return GradientResult(
-        gradient=final_bwd_state - fwd_diff,
-        forward_diff=fwd_diff,
-    )
+    # gradient = final backward state - fwd_diff,
+    # where the final backward state is
+    # (-pressure, -flux - p_step^T pressure)
+    gradient = sim_bwd.state
+    gradient.flux += step_mats.p_t @ gradient.pressure
+    gradient += diff
+    gradient *= -1.0
+
+    return gradient.astype(np.float64)
+
+
+@dataclass
+class Preconditioner:
+    """Diagonal (Jacobi) preconditioner for the conjugate gradient method."""
+
+    diag_inv: npt.NDArray[np.float64]
+
+    @classmethod
+    def estimate(cls, probe_count: int):
+        """Estimate the diagonal of the controllability operator A
+        with Hutchinson's estimator diag(A) ~ mean(z * Az)
+        over random probes z with entries of +-1.
+        Each probe costs one cost gradient computation."""
+
+        rng = np.random.default_rng(0)
+        diag_sum = np.zeros(State.pressure_len + State.flux_len)
+        for _ in range(probe_count):
+            probe = State(x=rng.choice([-1.0, 1.0], size=len(diag_sum)))
+            a_probe = compute_cost_gradient(probe, use_source_terms=False).gradient
+            diag_sum += probe.x * a_probe.x
+        diag = diag_sum / probe_count
+        # A is positive definite so its diagonal is positive,
+        # but with few probes some estimates may not be.
+        # clamp those to keep the preconditioner positive definite
+        diag = np.maximum(diag, 0.1 * diag.mean())
+        return cls(diag_inv=1.0 / diag)
+
+    def apply(self, state: State) -> State:
+        return State(x=self.diag_inv * state.x)
 
 
 def compute_control_energy(state: State) -> float:
     """Compute the control energy of a given initial state."""
 
-    period_sim = ForwardSolve(state.copy())
+    period_sim = ForwardSolve(state.astype(sim_dtype))
     for _ in range(steps_per_period):
         period_sim.step()
     return (period_sim.state - state).energy()
@@ -530,17 +839,51 @@ class SolveResults:
     forward_time_ms: int
 
 
-def solve():
-    zero_state = State(
-        pressure=np.zeros(cmp_complex[2].num_simplices),
-        flux=np.zeros(cmp_complex[1].num_simplices),
+# version of the cached initial state.
+# bump this whenever the transition simulation changes
+# (e.g. its length, the easing or the timestep kernel)
+# so that stale cache files aren't used
+initial_state_cache_version = 1
+
+
+def initial_state_cache_path() -> str:
+    """Path of the file where the initial state of the optimization
+    is stored between runs. The name is a hash of every parameter
+    that affects the transition simulation computing the initial state."""
+
+    key = repr(
+        (
+            initial_state_cache_version,
+            np.dtype(sim_dtype).name,
+            args.shape,
+            args.star_points,
+            args.mesh_scaling,
+            args.triangle_scaling,
+            args.inc_angle,
+            args.wavenumber,
+            step_mats.name,
+        )
     )
+    key_hash = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(".cache", f"init_state_{key_hash}.npz")
 
-    # ease in the source terms to obtain smooth initial values for optimization
 
-    transition_time = 5 * wave_period
-    transition_step_count = math.ceil(transition_time / dt)
-    transition_sim = ForwardSolve(state=zero_state.copy())
+def compute_initial_state() -> State:
+    """Ease in the source terms over a few wave periods
+    to obtain smooth initial values for optimization.
+    The result is cached on disk since it only depends on the parameters.
+    A cached state that doesn't fit the mesh is recomputed."""
+
+    cache_path = initial_state_cache_path()
+    if not args.no_cache and os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            pressure = cached["pressure"]
+            flux = cached["flux"]
+        if len(pressure) == State.pressure_len and len(flux) == State.flux_len:
+            return State(pressure=pressure, flux=flux)
+        print(f"Ignoring {cache_path} that doesn't match the mesh")
+
+    transition_sim = ForwardSolve(state=State().astype(sim_dtype))
 
     def easing(t: float) -> float:
         sin_val = math.sin((t / transition_time) * (np.pi / 2.0))
@@ -549,21 +892,36 @@ def solve():
     for _ in range(transition_step_count):
         transition_sim.step(source_term_scaling=easing)
 
-    initial_state = transition_sim.state
+    initial_state = transition_sim.state.astype(np.float64)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    np.savez_compressed(
+        cache_path, pressure=initial_state.pressure, flux=initial_state.flux
+    )
+    return initial_state
 
-    # begin conjugate gradient optimization
+
+def solve():
+    initial_state = compute_initial_state()
+
+    # begin (preconditioned) conjugate gradient optimization
 
     state = initial_state.copy()
     stop_condition_sq = (1e-2) ** 2
-    residual = -compute_cost_gradient(state, use_source_terms=True).gradient
+    initial_gradient = compute_cost_gradient(state, use_source_terms=True)
+    residual = -initial_gradient.gradient
+    # the difference between the current state and its simulation
+    # over one period depends linearly on the state,
+    # so it can be kept up to date without extra simulations
+    # using the forward differences from each residual update
+    # and used to measure the control energy
+    control_diff = initial_gradient.forward_diff
     initial_resid_norm_sq = residual.dot(residual)
     resid_norm_sq = initial_resid_norm_sq
-    search_dir = residual.copy()
 
     results = SolveResults(
         state=state,
         step_count=0,
-        control_energies=[compute_control_energy(state)],
+        control_energies=[control_diff.energy()],
         forward_energies=[],
         resid_norms=[math.sqrt(initial_resid_norm_sq)],
         a_inner_prods=[0.0],
@@ -575,21 +933,32 @@ def solve():
 
     start_time = perf_counter_ns()
 
+    if args.precond_probes > 0:
+        apply_precond = Preconditioner.estimate(args.precond_probes).apply
+    else:
+        apply_precond = State.copy
+    search_dir = apply_precond(residual)
+    # inner product of the residual and preconditioned residual
+    resid_precond_dot = residual.dot(search_dir)
+
     for _ in range(args.max_iters):
-        resid_update = compute_cost_gradient(
-            search_dir, use_source_terms=False
-        ).gradient
-        solution_update_param = resid_norm_sq / resid_update.dot(search_dir)
-        results.state += search_dir.scaled(solution_update_param)
-        residual -= resid_update.scaled(solution_update_param)
-
-        next_resid_norm_sq = residual.dot(residual)
-        resid_norm_proportion = next_resid_norm_sq / resid_norm_sq
-        resid_norm_sq = next_resid_norm_sq
-        search_dir = residual + search_dir.scaled(resid_norm_proportion)
+        search_dir_gradient = compute_cost_gradient(search_dir, use_source_terms=False)
+        resid_update = search_dir_gradient.gradient
+        solution_update_param = resid_precond_dot / resid_update.dot(search_dir)
+        results.state.add_scaled(search_dir, solution_update_param)
+        residual.add_scaled(resid_update, -solution_update_param)
+        control_diff.add_scaled(search_dir_gradient.forward_diff, solution_update_param)
+        resid_norm_sq = residual.dot(residual)
+
+        precond_resid = apply_precond(residual)
+        next_resid_precond_dot = residual.dot(precond_resid)
+        search_dir_proportion = next_resid_precond_dot / resid_precond_dot
+        resid_precond_dot = next_resid_precond_dot
+        search_dir *= search_dir_proportion
+        search_dir += precond_resid
 
         # measurements
-        results.control_energies.append(compute_control_energy(results.state))
+        results.control_energies.append(control_diff.energy())
         results.resid_norms.append(math.sqrt(resid_norm_sq))
         results.a_inner_prods.append(resid_update.dot(search_dir))
         results.step_count += 1
@@ -606,7 +975,7 @@ def solve():
     # to compare results to
     forward_state = initial_state.copy()
     for _ in range(results.step_count + 1):
-        period_sim = ForwardSolve(forward_state.copy())
+        period_sim = ForwardSolve(forward_state.astype(sim_dtype))
         for _ in range(steps_per_period):
             period_sim.step()
         results.forward_energies.append((period_sim.state - forward_state).energy())
@@ -623,8 +992,7 @@ def solve():
 results_harmonic = solve()
 
 print("Switching to Yee timestep operators...")
-p_step_mat = p_step_mat_yee
-q_step_mat = q_step_mat_yee
+step_mats = step_mats_yee
 results_yee = solve()
 
 
@@ -639,8 +1007,7 @@ print(f"Magnitude of harmonic solution: {har_norm}")
 print(f"Difference between Yee and harmonic solution: {yee_har_diff}")
 print(f"Relative difference: {yee_har_diff / har_norm:.2%}")
 
-p_step_mat = p_step_mat_har
-q_step_mat = q_step_mat_har
+step_mats = step_mats_har
 yee_energy_har = compute_control_energy(results_yee.state)
 print(f"Yee solution's final energy: {results_yee.control_energies[-1]}")
 print(f"Harmonic solution's final energy: {results_harmonic.control_energies[-1]}")
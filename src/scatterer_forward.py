@@ -17,6 +17,8 @@ cmp_complex = cmp_mesh.complex
 measure_mesh.print_measurements(cmp_complex)
 inner_bound_edges: list[int] = cmp_mesh.edge_groups["inner boundary"]
 outer_bound_edges: list[int] = cmp_mesh.edge_groups["outer boundary"]
+inner_bound_mask = np.zeros(cmp_complex[1].num_simplices, dtype=np.bool_)
+inner_bound_mask[np.asarray(inner_bound_edges, dtype=np.intp)] = True
 
 
 # for each outer boundary edge, find the triangle this edge is part of
@@ -144,7 +146,7 @@ class CircleScatterer(Simulation):
 
         inc_wave: npt.NDArray[np.float64] = np.zeros(cmp_complex[1].num_simplices)
         for edge_idx in range(len(inc_wave)):
-            if edge_idx in inner_bound_edges:
+            if inner_bound_mask[edge_idx]:
                 continue
             inc_wave[edge_idx] = self._eval_inc_wave_flux(
                 self.t + 0.5 * self.dt, cmp_complex[1].simplices[edge_idx]